@@ -9,10 +9,18 @@ https://github.com/AtsushiSakai/PythonRobotics
 '''
 
 import math
+from dataclasses import InitVar, dataclass, field
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional, without it the numpy versions of the kernels are used
+    NUMBA_AVAILABLE = False
+
 # Fast SLAM covariance
 Q = np.diag([3.0, np.deg2rad(10.0)]) ** 2
 R = np.diag([1.0, np.deg2rad(20.0)]) ** 2
@@ -22,6 +30,16 @@ Qsim = np.diag([0.3, np.deg2rad(2.0)]) ** 2
 Rsim = np.diag([0.5, np.deg2rad(10.0)]) ** 2
 OFFSET_YAWRATE_NOISE = 0.01
 
+# Cholesky factors used to draw correlated noise from the covariances above
+R_CHOL = np.linalg.cholesky(R)
+QSIM_CHOL = np.linalg.cholesky(Qsim)
+RSIM_CHOL = np.linalg.cholesky(Rsim)
+
+# Random number generator shared by all the noise draws, set RNG_SEED to
+# repeat a run
+RNG_SEED = None
+rng = np.random.default_rng(RNG_SEED)
+
 DT = 0.1  # time tick [s]
 SIM_TIME = 50.0  # simulation time [s]
 MAX_RANGE = 20.0  # maximum observation range
@@ -36,19 +54,29 @@ show_animation = True
 '''
 A class to represent the samples/particles generated by the motion model 
 These particles are a prediction about the rover's posterior 
+Each field holds the value for every particle in one array (structure of
+arrays), so that the filter steps can work on all the particles at once
 '''
-class Particle:
-
-    def __init__(self, N_LM):
+@dataclass
+class ParticleSet:
+    N_LM: InitVar[int]
+    w: np.ndarray = field(init=False)
+    x: np.ndarray = field(init=False)
+    y: np.ndarray = field(init=False)
+    yaw: np.ndarray = field(init=False)
+    lm: np.ndarray = field(init=False)
+    lmP: np.ndarray = field(init=False)
+
+    def __post_init__(self, N_LM):
         # * As the number of particles increase their weights decrease
-        self.w = 1.0 / N_PARTICLE
-        self.x = 0.0
-        self.y = 0.0
-        self.yaw = 0.0
+        self.w = np.full(N_PARTICLE, 1.0 / N_PARTICLE)
+        self.x = np.zeros(N_PARTICLE)
+        self.y = np.zeros(N_PARTICLE)
+        self.yaw = np.zeros(N_PARTICLE)
         # landmark x-y positions
-        self.lm = np.zeros((N_LM, LM_SIZE))
+        self.lm = np.zeros((N_PARTICLE, N_LM, LM_SIZE))
         # landmark position covariance
-        self.lmP = np.zeros((N_LM * LM_SIZE, LM_SIZE))
+        self.lmP = np.zeros((N_PARTICLE, N_LM, LM_SIZE, LM_SIZE))
 
 '''
 Function: fast_slam 
@@ -80,25 +108,16 @@ Parameters:
     u: Controls given to the rover
 '''
 def motion_model(x, u):
-    # The state matrix 
-    # In the demo only an identity matrix 
-    F = np.array([[1.0, 0, 0],
-                  [0, 1.0, 0],
-                  [0, 0, 1.0]])
-
-    # Input matrix
-    B = np.array([[DT * math.cos(x[2, 0]), 0],
-                  [DT * math.sin(x[2, 0]), 0],
-                  [0.0, DT]])
-
-    # Update the position of the rover based on the controls 
-    # * Doesn't adjust for any noise
-    x = F @ x + B @ u
-
-    # Convert the angle into the first quadrant 
-    x[2, 0] = pi_2_pi(x[2, 0])
+    yaw = x[2]
+    v = u[0]
 
-    return x
+    # Update the position of the rover based on the controls, this is
+    # x = F @ x + B @ u written out with F the identity matrix, and the
+    # angle wrapped into [-pi, pi)
+    # * Doesn't adjust for any noise
+    return np.array([x[0] + DT * math.cos(yaw) * v,
+                     x[1] + DT * math.sin(yaw) * v,
+                     pi_2_pi(yaw + DT * u[1])])
 
 
 '''
@@ -118,7 +137,7 @@ def calc_input(time):
         v = 1.0  # [m/s]
         yawrate = 0.1  # [rad/s]
 
-    u = np.array([v, yawrate]).reshape(2, 1)
+    u = np.array([v, yawrate])
 
     return u
 
@@ -127,55 +146,70 @@ def observation(xTrue, xd, u, RFID):
     # calc true state
     xTrue = motion_model(xTrue, u)
 
-    # add noise to range observation
-    z = np.zeros((3, 0))
-    for i in range(len(RFID[:, 0])):
+    # range and bearing to every landmark
+    dx = RFID[:, 0] - xTrue[0]
+    dy = RFID[:, 1] - xTrue[1]
+    d = np.hypot(dx, dy)
+    angle = pi_2_pi_vec(np.arctan2(dy, dx) - xTrue[2])
 
-        dx = RFID[i, 0] - xTrue[0, 0]
-        dy = RFID[i, 1] - xTrue[1, 0]
-        d = math.hypot(dx, dy)
-        angle = pi_2_pi(math.atan2(dy, dx) - xTrue[2, 0])
-        if d <= MAX_RANGE:
-            dn = d + np.random.randn() * Qsim[0, 0] ** 0.5  # add noise
-            anglen = angle + np.random.randn() * Qsim[1, 1] ** 0.5  # add noise
-            zi = np.array([dn, pi_2_pi(anglen), i]).reshape(3, 1)
-            z = np.hstack((z, zi))
+    # add noise to range observation of the landmarks within range
+    mask = d <= MAX_RANGE
+    noise = rng.standard_normal((np.count_nonzero(mask), 2)) @ QSIM_CHOL.T
+    dn = d[mask] + noise[:, 0]
+    anglen = pi_2_pi_vec(angle[mask] + noise[:, 1])
+    z = np.stack([dn, anglen, np.flatnonzero(mask)])
 
     # add noise to input
-    ud1 = u[0, 0] + np.random.randn() * Rsim[0, 0] ** 0.5
-    ud2 = u[1, 0] + np.random.randn() * Rsim[1, 1] ** 0.5 + OFFSET_YAWRATE_NOISE
-    ud = np.array([ud1, ud2]).reshape(2, 1)
+    ud = u + rng.standard_normal(2) @ RSIM_CHOL.T
+    ud[1] += OFFSET_YAWRATE_NOISE
 
     xd = motion_model(xd, ud)
 
     return xTrue, z, xd, ud
 
 
-def motion_model(x, u):
-    F = np.array([[1.0, 0, 0],
-                  [0, 1.0, 0],
-                  [0, 0, 1.0]])
-
-    B = np.array([[DT * math.cos(x[2, 0]), 0],
-                  [DT * math.sin(x[2, 0]), 0],
-                  [0.0, DT]])
+'''
+Function: pi_2_pi
+    A function to wrap an angle into [-pi, pi)
 
-    x = F @ x + B @ u
+Parameters: 
+    angle - The angle required to convert 
+'''
+def pi_2_pi(angle):
+    # the same floor modulo as pi_2_pi_vec, so both map pi to -pi
+    return (angle + math.pi) % math.tau - math.pi
 
-    x[2, 0] = pi_2_pi(x[2, 0])
+'''
+Function: pi_2_pi_vec
+    The array version of pi_2_pi, wraps every angle of an array into
+    [-pi, pi) at once
 
-    return x
+Parameters:
+    angles - The array of angles required to convert
+'''
+def pi_2_pi_vec(angles):
+    return np.remainder(angles + math.pi, math.tau) - math.pi
 
+if NUMBA_AVAILABLE:
+    pi_2_pi_vec = njit(pi_2_pi_vec)
 
 '''
-Function: pi_2_pi
-    A function to convert angle into the first quadrant 
+Function: calc_final_state
+    A function to estimate the state of the rover as the weighted average
+    of the states of all the particles
 
-Parameters: 
-    angle - The angle required to convert 
+Parameters:
+    particles - The samples generated by the particle filter
 '''
-def pi_2_pi(angle):
-    return (angle + math.pi) % (2 * math.pi) - math.pi
+def calc_final_state(particles):
+    particles = normalize_weight(particles)
+
+    xEst = np.average(np.stack([particles.x, particles.y, particles.yaw]),
+                      axis=1, weights=particles.w)
+
+    xEst[2] = pi_2_pi(xEst[2])
+
+    return xEst
 
 '''
 Function: predict_particles
@@ -189,23 +223,46 @@ Parameters:
 '''
 def predict_particles(particles, u):
 
-    # For each particle produce a new sample
-    for i in range(N_PARTICLE):
-        px = np.zeros((STATE_SIZE, 1))
-        px[0, 0] = particles[i].x
-        px[1, 0] = particles[i].y
-        px[2, 0] = particles[i].yaw
-        # adding noise to the original control
-        ud = u + (np.random.randn(1, 2) @ R ** 0.5).T
-        # Run the state of particles and the noisy controls through the motion model  
-        px = motion_model(px, ud)
-        # Update the new state of the particles 
-        particles[i].x = px[0, 0]
-        particles[i].y = px[1, 0]
-        particles[i].yaw = px[2, 0]
+    # adding noise to the original control, one sample for each particle
+    noise = rng.standard_normal((particles.x.shape[0], 2)) @ R_CHOL.T
+    v = u[0] + noise[:, 0]
+    w = u[1] + noise[:, 1]
+
+    # Run the state of all the particles and the noisy controls through the
+    # motion model at once
+    predict_batch(particles.x, particles.y, particles.yaw, v, w, DT)
 
     return particles
 
+'''
+Function: predict_batch
+    The kernel of predict_particles, moves every particle through the motion
+    model in place. Compiled into a single loop when numba is available
+
+Parameters:
+    x, y, yaw - The state arrays of the particles
+    v, w - The noisy speed and yaw rate for each particle
+    dt - The time tick
+'''
+def _predict_batch_np(x, y, yaw, v, w, dt):
+    x += dt * np.cos(yaw) * v
+    y += dt * np.sin(yaw) * v
+    yaw[:] = pi_2_pi_vec(yaw + dt * w)
+
+if NUMBA_AVAILABLE:
+    # serial, for 100 particles the threads of parallel=True cost more than
+    # they save
+    @njit(fastmath=True)
+    def _predict_batch_jit(x, y, yaw, v, w, dt):
+        for i in range(x.shape[0]):
+            x[i] += dt * math.cos(yaw[i]) * v[i]
+            y[i] += dt * math.sin(yaw[i]) * v[i]
+            yaw[i] = pi_2_pi_vec(yaw[i] + dt * w[i])
+
+    predict_batch = _predict_batch_jit
+else:
+    predict_batch = _predict_batch_np
+
 '''
 Function: resampling
     A function used to draw a new set of particles after considering the affect
@@ -223,48 +280,64 @@ def resampling(particles):
     # normalise the weights of the particles
     particles = normalize_weight(particles)
 
-    # generate an array storing the weights of all the particles 
-    pw = []
-    for i in range(N_PARTICLE):
-        pw.append(particles[i].w)
-
-    pw = np.array(pw)
-
-    # calculate the effective particle number (note the matrix multiplication 
-    # has been replaced with the numpy matmul method as the "@" syntax is not
-    # valid in Python 2)
-    #Neff = 1.0 / (pw @ pw.T)  # Effective particle number
-    Neff = 1.0 / (np.matmul(pw, pw.T))  # Effective particle number
+    # calculate the effective particle number
+    Neff = 1.0 / np.dot(particles.w, particles.w)  # Effective particle number
 
     # run the resampling if the effective number of particles is below the set
-    # threshold
+    # threshold, the cumulative weights are only needed in that case
     if Neff < NTH:  # resampling
-        wcum = np.cumsum(pw)
-        base = np.cumsum(pw * 0.0 + 1 / N_PARTICLE) - 1 / N_PARTICLE
-        resampleid = base + np.random.rand(base.shape[0]) / N_PARTICLE
-
-        # iterate through all the particles and store the indices of those drawn
-        # at random based off its weight
-        inds = []
-        ind = 0
-        for ip in range(N_PARTICLE):
-            while (ind < wcum.shape[0] - 1) and (resampleid[ip] > wcum[ind]):
-                ind += 1
-            inds.append(ind)
+        wcum = np.cumsum(particles.w)
+        # systematic resampling, a single random offset shared by all the
+        # evenly spaced sample points
+        inds = resample_indices(wcum, rng.random())
 
         # replace particles in the original set with the new set of freshly
         # drawn particles
-        tparticles = particles[:]
-        for i in range(len(inds)):
-            particles[i].x = tparticles[inds[i]].x
-            particles[i].y = tparticles[inds[i]].y
-            particles[i].yaw = tparticles[inds[i]].yaw
-            particles[i].lm = tparticles[inds[i]].lm[:, :]
-            particles[i].lmP = tparticles[inds[i]].lmP[:, :]
-            particles[i].w = 1.0 / N_PARTICLE
+        particles.x = particles.x[inds]
+        particles.y = particles.y[inds]
+        particles.yaw = particles.yaw[inds]
+        particles.lm = particles.lm[inds]
+        particles.lmP = particles.lmP[inds]
+        particles.w.fill(1.0 / N_PARTICLE)
 
     return particles
 
+'''
+Function: resample_indices
+    The kernel of resampling, finds the particle drawn at each of the evenly
+    spaced sample points. Compiled into a single linear scan of the
+    cumulative weights when numba is available
+
+Paramters:
+    wcum - The cumulative sum of the normalised particle weights
+    u0 - The random offset in [0, 1) shared by all the sample points
+'''
+def _resample_indices_np(wcum, u0):
+    n = wcum.shape[0]
+    resampleid = (np.arange(n) + u0) / n
+    # clipped in case rounding leaves wcum[-1] just below 1
+    return np.searchsorted(wcum, resampleid).clip(max=n - 1)
+
+if NUMBA_AVAILABLE:
+    @njit
+    def _resample_indices_jit(wcum, u0):
+        n = wcum.shape[0]
+        inds = np.empty(n, dtype=np.int64)
+        ind = 0
+        for ip in range(n):
+            resampleid = (ip + u0) / n
+            # stop at the last particle in case rounding leaves wcum[-1]
+            # just below 1
+            while ind < n - 1 and resampleid > wcum[ind]:
+                ind += 1
+            inds[ip] = ind
+
+        return inds
+
+    resample_indices = _resample_indices_jit
+else:
+    resample_indices = _resample_indices_np
+
 '''
 Function: normalize_weight
     A function used to normalise the weights associated with each particle in
@@ -274,16 +347,15 @@ Paramters:
     particles - The sample generated by the particle filter
 '''
 def normalize_weight(particles):
-    sumw = sum([p.w for p in particles])
-
-    try:
-        for i in range(N_PARTICLE):
-            particles[i].w /= sumw
-    except ZeroDivisionError:
-        for i in range(N_PARTICLE):
-            particles[i].w = 1.0 / N_PARTICLE
+    sumw = particles.w.sum()
 
-        return particles
+    if not sumw:
+        # every weight has vanished, fall back to equally likely particles
+        particles.w.fill(1.0 / N_PARTICLE)
+    elif not math.isclose(sumw, 1.0):
+        # skipped when already normalised, e.g. in calc_final_state after
+        # resampling has normalised the weights earlier in the tick
+        particles.w *= 1.0 / sumw
 
     return particles
 
@@ -291,8 +363,6 @@ def normalize_weight(particles):
 def main():
     print(__file__ + " start!!")
 
-    time = 0.0
-
     # RFID positions [x, y]
     # Random Landmark coordinatess
     RFID = np.array([[10.0, -2.0],
@@ -308,21 +378,46 @@ def main():
     N_LM = RFID.shape[0]
 
     # State Vector [x y yaw v]'
-    xEst = np.zeros((STATE_SIZE, 1))  # SLAM estimation
-    xTrue = np.zeros((STATE_SIZE, 1))  # True state
-    xDR = np.zeros((STATE_SIZE, 1))  # Dead reckoning
-
-    # history
-    hxEst = xEst
-    hxTrue = xTrue
-    hxDR = xTrue
+    xEst = np.zeros(STATE_SIZE)  # SLAM estimation
+    xTrue = np.zeros(STATE_SIZE)  # True state
+    xDR = np.zeros(STATE_SIZE)  # Dead reckoning
+
+    # number of time ticks, counted once so that adding up DT in floating
+    # point cannot run past the history buffers
+    n_ticks = math.floor(SIM_TIME / DT + 1e-9) + 1
+
+    # history, one column per time tick plus the initial state
+    hxEst = np.zeros((STATE_SIZE, n_ticks + 1))
+    hxTrue = np.zeros((STATE_SIZE, n_ticks + 1))
+    hxDR = np.zeros((STATE_SIZE, n_ticks + 1))
+    hxEst[:, 0] = xEst
+    hxTrue[:, 0] = xTrue
+    hxDR[:, 0] = xTrue
 
     # Initalise the particles based on the landmarks
-    particles = [Particle(N_LM) for _ in range(N_PARTICLE)]
+    particles = ParticleSet(N_LM)
+
+    if show_animation:  # pragma: no cover
+        # create the plot artists once, each tick only updates their data
+        fig, ax = plt.subplots()
+        # for stopping simulation with the esc key.
+        fig.canvas.mpl_connect('key_release_event',
+                lambda event: [exit(0) if event.key == 'escape' else None])
+        ax.plot(RFID[:, 0], RFID[:, 1], "*k")
+
+        particles_art = ax.scatter(particles.x, particles.y, c="r", s=4)
+        lm_art, = ax.plot([], [], "xb")
+
+        true_art, = ax.plot([], [], "-b")
+        dr_art, = ax.plot([], [], "-k")
+        est_art, = ax.plot([], [], "-r")
+        x_est_art, = ax.plot([], [], "xk")
+        ax.set_aspect("equal", adjustable="datalim")
+        ax.grid(True)
 
     # Run the program until time runs out
-    while SIM_TIME >= time:
-        time += DT
+    for step in range(1, n_ticks + 1):
+        time = step * DT
 
         # Generate commands (random)
         u = calc_input(time)
@@ -338,29 +433,35 @@ def main():
         x_state = xEst[0: STATE_SIZE]
 
         # store data history
-        hxEst = np.hstack((hxEst, x_state))
-        hxDR = np.hstack((hxDR, xDR))
-        hxTrue = np.hstack((hxTrue, xTrue))
+        hxEst[:, step] = x_state
+        hxDR[:, step] = xDR
+        hxTrue[:, step] = xTrue
 
         if show_animation:  # pragma: no cover
-            plt.cla()
-            # for stopping simulation with the esc key.
-            plt.gcf().canvas.mpl_connect('key_release_event',
-                    lambda event: [exit(0) if event.key == 'escape' else None])
-            plt.plot(RFID[:, 0], RFID[:, 1], "*k")
-
-            for i in range(N_PARTICLE):
-                plt.plot(particles[i].x, particles[i].y, ".r")
-                plt.plot(particles[i].lm[:, 0], particles[i].lm[:, 1], "xb")
-
-            plt.plot(hxTrue[0, :], hxTrue[1, :], "-b")
-            plt.plot(hxDR[0, :], hxDR[1, :], "-k")
-            plt.plot(hxEst[0, :], hxEst[1, :], "-r")
-            plt.plot(xEst[0], xEst[1], "xk")
-            plt.axis("equal")
-            plt.grid(True)
+            particle_xy = np.c_[particles.x, particles.y]
+            particles_art.set_offsets(particle_xy)
+            lm_art.set_data(particles.lm[:, :, 0].ravel(),
+                            particles.lm[:, :, 1].ravel())
+
+            true_art.set_data(hxTrue[0, :step + 1], hxTrue[1, :step + 1])
+            dr_art.set_data(hxDR[0, :step + 1], hxDR[1, :step + 1])
+            est_art.set_data(hxEst[0, :step + 1], hxEst[1, :step + 1])
+            x_est_art.set_data([xEst[0]], [xEst[1]])
+
+            # rescale only when the particles or the newest path points
+            # leave the current view, not on every tick
+            points = np.vstack([particle_xy, hxTrue[:2, step],
+                                hxDR[:2, step], hxEst[:2, step]])
+            (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+            if (points[:, 0].min() < x0 or points[:, 0].max() > x1
+                    or points[:, 1].min() < y0 or points[:, 1].max() > y1):
+                ax.update_datalim(points)
+                ax.autoscale_view()
+            fig.canvas.draw_idle()
             plt.pause(0.001)
-       
+
+    return hxEst, hxTrue, hxDR
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,104 @@
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + "/../")
+try:
+    from SLAM import fastSLAM
+except:
+    raise
+
+import numpy as np
+import pytest
+
+
+def make_particles(N_LM=3):
+    particles = fastSLAM.ParticleSet(N_LM)
+    # tag every field of a particle with its index so copies can be traced
+    ids = np.arange(fastSLAM.N_PARTICLE, dtype=float)
+    particles.x = ids.copy()
+    particles.y = ids.copy()
+    particles.yaw = ids.copy()
+    particles.lm[:] = ids[:, None, None]
+    particles.lmP[:] = ids[:, None, None, None]
+    return particles, ids
+
+
+def test_resampling_duplicates_heavy_particle(monkeypatch):
+    particles, _ = make_particles()
+    # half of the weight on the first particle and the other half spread
+    # over the next 50, so most particles are replaced by a copy of one with
+    # a lower index
+    particles.w = np.zeros(fastSLAM.N_PARTICLE)
+    particles.w[0] = 0.5
+    particles.w[1:51] = 0.01
+
+    monkeypatch.setattr(fastSLAM, "rng", np.random.default_rng(0))
+    # the first 50 sample points fall on the first particle, each of the
+    # rest on the next of the particles with weight 0.01
+    expected = np.concatenate([np.zeros(50), np.arange(1.0, 51.0)])
+
+    particles = fastSLAM.resampling(particles)
+
+    assert np.array_equal(particles.x, expected)
+    # every field of a particle must still come from the same original particle
+    assert np.array_equal(particles.y, expected)
+    assert np.array_equal(particles.yaw, expected)
+    assert np.array_equal(particles.lm[:, 0, 0], expected)
+    assert np.array_equal(particles.lmP[:, 0, 0, 0], expected)
+    assert np.allclose(particles.w, 1.0 / fastSLAM.N_PARTICLE)
+
+
+def test_resampling_skipped_for_even_weights():
+    particles, ids = make_particles()
+
+    particles = fastSLAM.resampling(particles)
+
+    assert np.array_equal(particles.x, ids)
+    assert np.array_equal(particles.lm[:, 0, 0], ids)
+
+
+def test_angle_wraps_agree():
+    angles = np.array([-3 * np.pi, -np.pi, -1.0, 0.0, 1.0, np.pi, 3 * np.pi])
+
+    wrapped = fastSLAM.pi_2_pi_vec(angles)
+
+    assert np.array_equal(wrapped, [fastSLAM.pi_2_pi(a) for a in angles])
+    assert np.all((wrapped >= -np.pi) & (wrapped < np.pi))
+
+
+@pytest.mark.skipif(not fastSLAM.NUMBA_AVAILABLE, reason="numba is not installed")
+def test_compiled_kernels_match_numpy():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        x, y, v, w = rng.normal(size=(4, fastSLAM.N_PARTICLE))
+        yaw = rng.uniform(-np.pi, np.pi, fastSLAM.N_PARTICLE)
+        state_np = [x.copy(), y.copy(), yaw.copy()]
+        state_jit = [x.copy(), y.copy(), yaw.copy()]
+
+        fastSLAM._predict_batch_np(*state_np, v, w, fastSLAM.DT)
+        fastSLAM._predict_batch_jit(*state_jit, v, w, fastSLAM.DT)
+
+        for a, b in zip(state_np, state_jit):
+            assert np.allclose(a, b)
+
+        wcum = np.cumsum(rng.random(fastSLAM.N_PARTICLE))
+        wcum /= wcum[-1]
+        u0 = rng.random()
+        assert np.array_equal(fastSLAM._resample_indices_np(wcum, u0),
+                              fastSLAM._resample_indices_jit(wcum, u0))
+
+
+def test_main_runs_short_simulation(monkeypatch):
+    # SIM_TIME / DT is not exact in floating point, the history buffers must
+    # still hold every tick
+    monkeypatch.setattr(fastSLAM, "show_animation", False)
+    monkeypatch.setattr(fastSLAM, "SIM_TIME", 0.6)
+
+    hxEst, hxTrue, hxDR = fastSLAM.main()
+
+    # 7 ticks of 0.1 s plus the initial state
+    for history in (hxEst, hxTrue, hxDR):
+        assert history.shape == (fastSLAM.STATE_SIZE, 8)
+    # the rover stands still for the first 3 s, but the dead reckoning and
+    # the particles both take on noise so the last tick must be non-zero
+    assert np.any(hxDR[:, -1] != 0.0)
+    assert np.any(hxEst[:, -1] != 0.0)